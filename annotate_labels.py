@@ -1,17 +1,225 @@
+import concurrent.futures
+import functools
+import importlib.util
 import itertools
+import io
 import json
+import mmap
 import operator
 import os.path
 import tempfile
+import types
 
 import girder_client
-
-from PIL import Image, ImageDraw
+import numpy as np
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import rasterio.features
+    import rasterio.transform
+    import shapely
+except ImportError:
+    shapely = None
+else:
+    if int(shapely.__version__.split('.')[0]) < 2:
+        shapely = None
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+else:
+    # tifffile needs imagecodecs for zstd compression.
+    if importlib.util.find_spec('imagecodecs') is None:
+        tifffile = None
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+
+def _get_json(client, path, parameters=None):
+    response = client.get(path, parameters=parameters, jsonResp=False)
+    return _loads(response.content)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_colormap(filename, mtime):
+    with open(filename) as f:
+        colormap = json.load(f)
+    for name, label in colormap.items():
+        if (not isinstance(label, int) or isinstance(label, bool)
+                or not 0 <= label <= np.iinfo(np.uint16).max):
+            raise ValueError('label %s for annotation "%s" does not fit in '
+                             'uint16' % (label, name))
+    dtype = np.uint8 if max(colormap.values(), default=0) < 256 else np.uint16
+    return types.MappingProxyType({name: dtype(label)
+                                   for name, label in colormap.items()})
+
+
+def _annotation_name(annotation):
+    return annotation['annotation'].get('name') or ''
+
+
+def _prepare_elements(annotations):
+    rectangles = []
+    for annotation in annotations:
+        for element in annotation['annotation'].get('elements', ()):
+            if element['type'] == 'rectangle':
+                rectangles.append(element)
+            elif element['type'] == 'polyline':
+                element['_coords'] = np.ascontiguousarray(
+                    np.asarray(element['points'])[:, :2], dtype=np.int32)
+
+    if rectangles:
+        centers = np.array([e['center'][:2] for e in rectangles],
+                           dtype=np.float64)
+        sizes = np.array([(e['width'], e['height']) for e in rectangles],
+                         dtype=np.float64)
+        corners = np.floor(np.hstack((centers - sizes / 2,
+                                      centers + sizes / 2))).astype(np.int32)
+        for element, bbox in zip(rectangles, corners.tolist()):
+            element['_bbox'] = tuple(bbox)
+
+
+_SHAPE_GETTERS = {
+    'point': lambda element: element['center'][:2],
+    'rectangle': operator.itemgetter('_bbox'),
+    'polyline': operator.itemgetter('_coords'),
+}
+
+
+_IN_MEMORY_LIMIT = 64 * 1024 ** 2
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _draw_line(buf, x0, y0, x1, y1, color):
+        height, width = buf.shape[:2]
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+        err = dx + dy
+        while True:
+            if 0 <= x0 < width and 0 <= y0 < height:
+                buf[y0, x0] = color
+            if x0 == x1 and y0 == y1:
+                break
+            e2 = 2 * err
+            if e2 >= dy:
+                err += dy
+                x0 += sx
+            if e2 <= dx:
+                err += dx
+                y0 += sy
+
+    @numba.njit(parallel=True, cache=True)
+    def _fill_polygon(buf, ys, xs, color):
+        height, width = buf.shape[:2]
+        count = ys.shape[0]
+
+        # Edges are drawn as well as the interior, like ImageDraw.polygon
+        # with an outline and cv2.fillPoly, so horizontal edges and the last
+        # scanline are not lost to the half-open crossing rule below.
+        edges = np.empty((count, 4), dtype=np.float64)
+        n_edges = 0
+        for i in range(count):
+            j = (i + 1) % count
+            y0, x0, y1, x1 = ys[i], xs[i], ys[j], xs[j]
+            _draw_line(buf, int(np.rint(x0)), int(np.rint(y0)),
+                       int(np.rint(x1)), int(np.rint(y1)), color)
+            if y0 == y1:
+                continue
+            if y0 > y1:
+                y0, x0, y1, x1 = y1, x1, y0, x0
+            edges[n_edges, 0] = y0
+            edges[n_edges, 1] = y1
+            edges[n_edges, 2] = x0
+            edges[n_edges, 3] = (x1 - x0) / (y1 - y0)
+            n_edges += 1
+        if n_edges == 0:
+            return
+        edges = edges[:n_edges][np.argsort(edges[:n_edges, 0])]
+
+        top = max(int(np.ceil(edges[0, 0])), 0)
+        bottom = min(int(np.floor(edges[:, 1].max())), height - 1)
+        for y in numba.prange(top, bottom + 1):
+            crossings = np.empty(n_edges, dtype=np.float64)
+            n_crossings = 0
+            for i in range(n_edges):
+                if edges[i, 0] > y:
+                    break
+                if y < edges[i, 1]:
+                    crossings[n_crossings] = (edges[i, 2] +
+                                              (y - edges[i, 0]) * edges[i, 3])
+                    n_crossings += 1
+            crossings = np.sort(crossings[:n_crossings])
+            for i in range(0, n_crossings - 1, 2):
+                left = max(int(np.ceil(crossings[i])), 0)
+                right = min(int(np.floor(crossings[i + 1])), width - 1)
+                if left <= right:
+                    buf[y, left:right + 1] = color
+
+
+def _box_ring(x0, y0, x1, y1, margin=0.25):
+    x0, y0, x1, y1 = x0 - margin, y0 - margin, x1 + margin, y1 + margin
+    return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]],
+                    dtype=np.float64)
+
+
+def _draw_points(buf, xs, ys, colors):
+    height, width = buf.shape[:2]
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    buf[ys[inside], xs[inside]] = np.broadcast_to(colors, xs.shape)[inside]
+
+
+def _pooled_session():
+    # raise_on_status=False hands the last 5xx response back once retries
+    # run out, so girder_client still raises HttpError for it.
+    retry = urllib3.util.retry.Retry(
+        total=3, backoff_factor=0.5, allowed_methods=['GET'],
+        status_forcelist=[500, 502, 503, 504], raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8,
+                                            pool_maxsize=16,
+                                            max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _with_session(method):
+    # GirderClient.session() closes and unsets the session on exit, so it
+    # is only entered when the caller has not already opened one.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.client._session is not None:
+            return method(self, *args, **kwargs)
+        with self.client.session(_pooled_session()):
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class LabelAnnotator(object):
     def __init__(self, client):
         self.client = client
+        self._memoized_get = functools.lru_cache(maxsize=256)(self._get)
 
         self._colormap = None
         self._girder_id = None
@@ -20,6 +228,14 @@ class LabelAnnotator(object):
         self._overlay_item_id = None
         self._overlay_file = None
         self._annotations = None
+        self._image_cache = None
+
+    def _get(self, path, parameters):
+        return _get_json(self.client, path, dict(parameters))
+
+    def _cached_get(self, path, parameters=None):
+        parameters = tuple(sorted(parameters.items())) if parameters else ()
+        return self._memoized_get(path, parameters)
 
     @property
     def colormap(self):
@@ -31,27 +247,32 @@ class LabelAnnotator(object):
             self._colormap = None
             return
 
-        with open(colormap_filename) as f:
-            self._colormap = json.load(f)
+        mtime = os.path.getmtime(colormap_filename)
+        self._colormap = _load_colormap(colormap_filename, mtime)
 
     @property
     def girder_id(self):
         return self._girder_id
 
     @girder_id.setter
+    @_with_session
     def girder_id(self, girder_id):
-        self._gider_id = girder_id
+        if girder_id == self._girder_id and self._overlay_file is not None:
+            return
+        self._girder_id = None
         self._item_id = None
         self._overlay_item_id = None
+        self._overlay_file = None
+        self._annotations = None
 
         if girder_id is not None:
             if self._is_overlay_id:
-                overlay = self.client.get('overlay/%s' % girder_id)
+                overlay = self._cached_get('overlay/%s' % girder_id)
                 item_id = overlay['itemId']
             else:
                 item_id = girder_id
                 parameters = {'itemId': item_id}
-                overlays = self.client.get('overlay', parameters=parameters)
+                overlays = self._cached_get('overlay', parameters)
                 if not overlays:
                     raise ValueError('no overlay for item %s' % item_id)
                 if len(overlays) > 1:
@@ -63,6 +284,7 @@ class LabelAnnotator(object):
 
         self._update_overlay_file()
         self._update_annotations()
+        self._girder_id = girder_id
 
     @property
     def is_overlay_id(self):
@@ -70,6 +292,8 @@ class LabelAnnotator(object):
 
     @is_overlay_id.setter
     def is_overlay_id(self, is_overlay_id):
+        if is_overlay_id != self._is_overlay_id:
+            self._girder_id = None
         self._is_overlay_id = is_overlay_id
 
     @property
@@ -90,18 +314,16 @@ class LabelAnnotator(object):
             return
 
         path = 'item/%s/files' % self._overlay_item_id
-        overlay_files = self.client.get(path, parameters={'limit': 2})
+        overlay_files = self._cached_get(path, {'limit': 2})
         if not overlay_files:
             raise ValueError('no files for overlay %s' % self._overlay_item_id)
 
-        overlay_files = list(filter(lambda o: o['mimeType'].startswith('image'), overlay_files))
+        overlay_files = [o for o in overlay_files
+                         if o['mimeType'].startswith('image')]
         if len(overlay_files) > 1:
-            overlay_item = self.client.getItem(self._overlay_item_id)
-            try:
-                file_id = overlay_item['largeImage']['fileId']
-            except KeyError:
-                file_id = None
-            overlay_files = list(filter(lambda o: o['_id'] != file_id, overlay_files))
+            overlay_item = self._cached_get('item/%s' % self._overlay_item_id)
+            file_id = overlay_item.get('largeImage', {}).get('fileId')
+            overlay_files = [o for o in overlay_files if o['_id'] != file_id]
         if len(overlay_files) > 1:
             raise ValueError('multiple files for overlay %s' % self._overlay_item_id)
         self._overlay_file = overlay_files[0]
@@ -113,18 +335,24 @@ class LabelAnnotator(object):
             return
         path = 'annotation/item/%s' % self._item_id
         try:
-            self._annotations = client.get(path)
+            self._annotations = _get_json(self.client, path)
         except girder_client.HttpError as e:
             if e.status == 400:
-                parameters = {'itemId': self._item_id, 'limit': 0}
-                annotations = client.get('annotation', parameters=parameters)
-                self._annotations = []
-                for annotation in annotations:
-                    annotation = client.get('annotation/%s' %
-                                            annotation['_id'])
-                    self._annotations.append(annotation)
+                parameters = {'itemId': self._item_id, 'limit': 0,
+                              'sort': 'annotation.name', 'sortdir': 1}
+                annotations = _get_json(self.client, 'annotation', parameters)
+                if all('elements' in a['annotation'] for a in annotations):
+                    self._annotations = annotations
+                else:
+                    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                        self._annotations = list(executor.map(
+                            lambda a: _get_json(self.client, 'annotation/%s' %
+                                                a['_id']),
+                            annotations))
             else:
                 raise
+        self._annotations.sort(key=_annotation_name)
+        _prepare_elements(self._annotations)
 
 
     def _annotations_iterator(self):
@@ -134,18 +362,13 @@ class LabelAnnotator(object):
         if self._colormap is None:
             raise ValueError('no color mapping set')
 
-        def keyfunc(annotation):
-            if 'name' not in annotation['annotation']:
-                return
-            return annotation['annotation']['name']
-
-        iterator = itertools.groupby(self._annotations, keyfunc)
+        colormap = self._colormap
+        iterator = itertools.groupby(self._annotations, _annotation_name)
         for name, annotation_group in iterator:
-            if name is None:
+            if not name:
                 continue
-            try:
-                color = self._colormap[name]
-            except KeyError:
+            color = colormap.get(name)
+            if color is None:
                 raise ValueError('no color mapping for annotation "%s"' % name)
             yield color, annotation_group
 
@@ -153,30 +376,105 @@ class LabelAnnotator(object):
     def annotations(self):
         return self._annotations_iterator()
 
-    def _draw_annotations(self):
-        image = self.image
-        draw = ImageDraw.Draw(image)
-
+    def _shapes_iterator(self):
         for color, annotation_group in self.annotations:
+            shapes = {element_type: [] for element_type in _SHAPE_GETTERS}
             for annotation in annotation_group:
                 for element in annotation['annotation']['elements']:
-                    if element['type'] == 'point':
-                        xy = [tuple(element['center'][:2])]
-                        draw.point(xy, fill=color)
-                    elif element['type'] == 'rectangle':
-                        xy = [
-                            tuple(element['center'][:2]),
-                            (element['center'][0] + element['width'],
-                             element['center'][1] + element['height'])
-                        ]
-                        draw.rectangle(xy, outline=color, fill=color)
-                    elif element['type'] == 'polyline':
-                        xy = [tuple(point[:2]) for point in element['points']]
-                        draw.polygon(xy, outline=color, fill=color)
-                    else:
+                    getter = _SHAPE_GETTERS.get(element['type'])
+                    if getter is None:
                         raise ValueError('invalid element type: %s' %
                                          element['type'])
-        return image
+                    shapes[element['type']].append(getter(element))
+            yield color, shapes
+
+    def _rasterize_annotations(self, buf):
+        for color, shapes in self._shapes_iterator():
+            # One polygon per call: fillPoly fills a list of polygons
+            # with the even-odd rule, which would hollow out overlaps.
+            for coords in shapes['polyline']:
+                cv2.fillPoly(buf, [coords], int(color), lineType=cv2.LINE_8)
+            for x0, y0, x1, y1 in shapes['rectangle']:
+                cv2.rectangle(buf, (x0, y0), (x1, y1), int(color),
+                              thickness=cv2.FILLED)
+            if shapes['point']:
+                xs, ys = np.array(shapes['point'], np.intp).T
+                _draw_points(buf, xs, ys, color)
+
+    def _burn_annotations(self, buf):
+        # Pixel (i, j) is centered on coordinate (i, j). Interiors burn the
+        # pixels whose centers they contain and outlines burn as lines,
+        # which together cover what cv2.fillPoly and the JIT fill cover.
+        transform = rasterio.transform.Affine.translation(-0.5, -0.5)
+        for color, shapes in self._shapes_iterator():
+            polygons = [c for c in shapes['polyline'] if len(c) >= 3]
+            rings = polygons + [_box_ring(*bbox)
+                                for bbox in shapes['rectangle']]
+            if shapes['point']:
+                rings.extend(_box_ring(x, y, x, y) for x, y in
+                             np.floor(np.array(shapes['point'], np.float64)))
+
+            geometries = []
+            if rings:
+                indices = np.repeat(np.arange(len(rings)),
+                                    [len(r) for r in rings])
+                geometries.extend(shapely.polygons(shapely.linearrings(
+                    np.concatenate(rings), indices=indices)))
+                geometries.extend(shapely.boundary(
+                    geometries[:len(polygons)]))
+            for coords in shapes['polyline']:
+                if len(coords) == 2:
+                    geometries.append(shapely.linestrings(coords))
+                elif len(coords) == 1:
+                    geometries.append(shapely.points(coords[0]))
+
+            if geometries:
+                rasterio.features.rasterize(
+                    ((geometry, color) for geometry in geometries),
+                    out=buf, transform=transform)
+
+    def _fill_annotations(self, buf):
+        for color, shapes in self._shapes_iterator():
+            for coords in shapes['polyline']:
+                _fill_polygon(buf, coords[:, 1], coords[:, 0], color)
+            if shapes['rectangle']:
+                bounds = np.array(shapes['rectangle'], dtype=np.intp)
+                bounds[:, 2:] += 1
+                np.maximum(bounds, 0, out=bounds)
+                for x0, y0, x1, y1 in bounds.tolist():
+                    buf[y0:y1, x0:x1] = color
+            if shapes['point']:
+                xs, ys = np.array(shapes['point'], np.intp).T
+                _draw_points(buf, xs, ys, color)
+
+    @property
+    def label_buffer(self):
+        image = self.image
+        if len(image.getbands()) > 1:
+            image = image.getchannel(0)
+        labels = np.asarray(image)
+
+        dtype = np.result_type(np.uint8, *(self._colormap or {}).values())
+        if (labels.dtype.itemsize > dtype.itemsize and labels.size and
+                0 <= labels.min() and labels.max() <= np.iinfo(dtype).max):
+            return labels.astype(dtype)
+        return labels.astype(np.result_type(labels.dtype, dtype))
+
+    def _draw_labels(self):
+        buf = self.label_buffer
+        if cv2 is not None:
+            self._rasterize_annotations(buf)
+        elif shapely is not None:
+            self._burn_annotations(buf)
+        elif numba is not None:
+            self._fill_annotations(buf)
+        else:
+            raise ImportError('drawing annotations needs cv2, shapely and '
+                              'rasterio, or numba')
+        return buf
+
+    def _draw_annotations(self):
+        return Image.fromarray(self._draw_labels())
 
     @property
     def image_file(self):
@@ -188,27 +486,67 @@ class LabelAnnotator(object):
         return image_file
 
     @property
+    @_with_session
     def image(self):
-        image_file = self.image_file
-
-        try:
-            image = Image.open(image_file.name)
-        except (IOError, OSError) as pillow_exception:
+        if self._overlay_file is None:
+            return
+        file_id = self._overlay_file['_id']
+        if self._image_cache is not None and self._image_cache[0] == file_id:
+            return self._image_cache[1]
+
+        image = None
+        stream = None
+        if self._overlay_file.get('size', 0) <= _IN_MEMORY_LIMIT:
+            stream = io.BytesIO()
+            for chunk in self.client.downloadFileAsIterator(file_id):
+                stream.write(chunk)
+            stream.seek(0)
             try:
-                import numpy
-                import pytiff
-                image = pytiff.Tiff(image_file.name)
-                image = Image.fromarray(numpy.array(image))
-            except (IOError, OSError) as pytiff_exception:
-                raise
+                image = Image.open(stream)
+            except (IOError, OSError):
+                pass
 
-        image_file.close()
+        if image is None:
+            if stream is None:
+                image_file = self.image_file
+            else:
+                extension = os.path.splitext(self._overlay_file['name'])[1]
+                image_file = tempfile.NamedTemporaryFile(suffix=extension)
+                image_file.write(stream.getbuffer())
+                image_file.flush()
 
+            try:
+                with mmap.mmap(image_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapping:
+                    image = Image.open(mapping)
+                    image.load()
+            except (IOError, OSError) as pillow_exception:
+                try:
+                    import pytiff
+                    with pytiff.Tiff(image_file.name, 'r') as tiff:
+                        image = Image.fromarray(tiff[:, :])
+                except (IOError, OSError) as pytiff_exception:
+                    raise
+
+            image_file.close()
+
+        self._image_cache = (file_id, image)
         return image
 
 
     def save(self, output_filename):
-        self._draw_annotations().save(output_filename)
+        labels = self._draw_labels()
+        extension = os.path.splitext(output_filename)[1].lower()
+        if tifffile is not None and extension in ('.tif', '.tiff'):
+            tifffile.imwrite(output_filename, labels, compression='zstd',
+                             predictor=True)
+        elif (cv2 is not None and extension == '.png' and
+                labels.dtype in (np.uint8, np.uint16)):
+            if not cv2.imwrite(output_filename, labels,
+                               [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+                raise IOError('could not write %s' % output_filename)
+        else:
+            Image.fromarray(labels).save(output_filename)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,297 @@
+import contextlib
+import io
+import json
+
+import numpy as np
+import pytest
+import requests
+
+from PIL import Image, ImageDraw
+
+import annotate_labels
+from annotate_labels import LabelAnnotator
+
+
+AXIS_ALIGNED = {
+    'square': [(2, 2), (12, 2), (12, 12), (2, 12)],
+    'notched': [(2, 2), (30, 2), (30, 10), (16, 10), (16, 30), (2, 30)],
+    'horizontal': [(3, 5), (20, 5)],
+}
+
+SLANTED = {
+    'triangle': [(2, 2), (30, 5), (15, 35)],
+    'concave': [(2, 2), (30, 2), (16, 16), (30, 30), (2, 30)],
+    'sliver': [(1, 1), (30, 3), (1, 4)],
+}
+
+
+requires_numba = pytest.mark.skipif(annotate_labels.numba is None,
+                                    reason='numba is not installed')
+
+
+def _fill(points):
+    points = np.array(points, dtype=np.int32)
+    buf = np.zeros((40, 40), dtype=np.uint8)
+    annotate_labels._fill_polygon(buf, points[:, 1], points[:, 0], 1)
+    return buf
+
+
+@requires_numba
+@pytest.mark.parametrize('name', sorted(AXIS_ALIGNED))
+def test_fill_polygon_matches_imagedraw(name):
+    image = Image.new('L', (40, 40))
+    ImageDraw.Draw(image).polygon(AXIS_ALIGNED[name], outline=1, fill=1)
+    np.testing.assert_array_equal(_fill(AXIS_ALIGNED[name]), np.array(image))
+
+
+@requires_numba
+@pytest.mark.parametrize('name', sorted(SLANTED))
+def test_fill_polygon_matches_fillpoly(name):
+    cv2 = pytest.importorskip('cv2')
+    expected = np.zeros((40, 40), dtype=np.uint8)
+    cv2.fillPoly(expected, [np.array(SLANTED[name], dtype=np.int32)], 1)
+    assert np.count_nonzero(_fill(SLANTED[name]) != expected) <= 2
+
+
+@requires_numba
+def test_fill_polygon_clips_to_buffer():
+    assert _fill([(-5, -5), (60, -5), (60, 60), (-5, 60)]).all()
+
+
+class FakeResponse(object):
+    def __init__(self, document):
+        self.content = json.dumps(document).encode()
+
+
+class FakeClient(object):
+    """Serves canned documents and records every REST path requested."""
+
+    def __init__(self, routes, overlay):
+        self.routes = routes
+        self.overlay = overlay
+        self.calls = []
+        self._session = None
+
+    # Mirrors GirderClient.session(), including unsetting on exit.
+    @contextlib.contextmanager
+    def session(self, session=None):
+        self._session = session if session else requests.Session()
+        yield self._session
+        self._session.close()
+        self._session = None
+
+    def get(self, path, parameters=None, jsonResp=True):
+        self.calls.append(path)
+        route = self.routes[path]
+        if callable(route):
+            route = route(parameters or {})
+        return FakeResponse(route)
+
+    def downloadFileAsIterator(self, file_id):
+        self.calls.append('file/%s/download' % file_id)
+        yield self.overlay
+
+
+def _overlay_png(size=(40, 40)):
+    stream = io.BytesIO()
+    Image.new('L', size).save(stream, 'PNG')
+    return stream.getvalue()
+
+
+def _routes(annotations, overlay):
+    return {
+        'overlay': lambda parameters: [{'overlayItemId': 'overlay-item'}],
+        'item/overlay-item/files': [{'_id': 'file', 'name': 'overlay.png',
+                                     'mimeType': 'image/png',
+                                     'size': len(overlay)}],
+        'annotation/item/item': annotations,
+    }
+
+
+def _annotator(tmp_path, annotations, colormap, size=(40, 40)):
+    overlay = _overlay_png(size)
+    client = FakeClient(_routes(annotations, overlay), overlay)
+    colormap_file = tmp_path / 'colormap.json'
+    colormap_file.write_text(json.dumps(colormap))
+
+    annotator = LabelAnnotator(client)
+    annotator.colormap = str(colormap_file)
+    annotator.girder_id = 'item'
+    return annotator
+
+
+def _annotation(name, *elements):
+    return {'annotation': {'name': name, 'elements': list(elements)}}
+
+
+def _polyline(points):
+    return {'type': 'polyline', 'points': [[x, y, 0] for x, y in points]}
+
+
+@pytest.fixture(params=['cv2', 'shapely', 'numba'])
+def backend(request, monkeypatch):
+    if getattr(annotate_labels, request.param) is None:
+        pytest.skip('%s is not installed' % request.param)
+    if request.param != 'cv2':
+        monkeypatch.setattr(annotate_labels, 'cv2', None)
+    if request.param == 'numba':
+        monkeypatch.setattr(annotate_labels, 'shapely', None)
+    return request.param
+
+
+def test_same_label_polygons_fill_their_union(tmp_path, backend):
+    squares = [[(2, 2), (12, 2), (12, 12), (2, 12)],
+               [(6, 6), (16, 6), (16, 16), (6, 16)]]
+    annotator = _annotator(tmp_path, [
+        _annotation('a', _polyline(squares[0])),
+        _annotation('a', _polyline(squares[1])),
+    ], {'a': 1})
+
+    expected = Image.new('L', (40, 40))
+    for square in squares:
+        ImageDraw.Draw(expected).polygon(square, outline=1, fill=1)
+    np.testing.assert_array_equal(annotator._draw_labels(),
+                                  np.array(expected))
+
+
+def _draw_with(monkeypatch, annotator, backend):
+    with monkeypatch.context() as patch:
+        if backend != 'cv2':
+            patch.setattr(annotate_labels, 'cv2', None)
+        if backend == 'numba':
+            patch.setattr(annotate_labels, 'shapely', None)
+        return annotator._draw_labels()
+
+
+@requires_numba
+def test_backends_agree_on_every_element_type(tmp_path, monkeypatch,
+                                              backend):
+    annotator = _annotator(tmp_path, [
+        _annotation('a',
+                    {'type': 'point', 'center': [30.6, 30.6, 0]},
+                    {'type': 'rectangle', 'center': [10.5, 30, 0],
+                     'width': 7, 'height': 4},
+                    _polyline([(3, 5), (20, 30)]),
+                    _polyline([(35, 2)])),
+        _annotation('b', _polyline([(2, 2), (30, 2), (2, 30)])),
+    ], {'a': 1, 'b': 2})
+
+    labels = annotator._draw_labels()
+    assert labels[30, 30] == 1 and np.count_nonzero(labels[29:33, 29:33]) == 1
+    assert labels[35, 2] == 0 and labels[2, 35] == 1
+    np.testing.assert_array_equal(
+        labels, _draw_with(monkeypatch, annotator, 'numba'))
+
+
+@requires_numba
+def test_backends_agree_on_random_polygons(tmp_path, monkeypatch, backend):
+    rng = np.random.default_rng(0)
+    polygons = [rng.integers(0, 200, (rng.integers(3, 8), 2)).tolist()
+                for _ in range(40)]
+    annotator = _annotator(tmp_path, [
+        _annotation('a', *(_polyline(p) for p in polygons[::2])),
+        _annotation('b', *(_polyline(p) for p in polygons[1::2])),
+    ], {'a': 1, 'b': 2}, size=(200, 200))
+
+    expected = _draw_with(monkeypatch, annotator, 'numba')
+    assert np.count_nonzero(annotator._draw_labels() != expected) <= 10
+
+
+def test_rectangle_is_centered_on_its_center(tmp_path, backend):
+    annotator = _annotator(tmp_path, [
+        _annotation('a', {'type': 'rectangle', 'center': [20, 10, 0],
+                          'width': 8, 'height': 6}),
+    ], {'a': 1})
+
+    expected = np.zeros((40, 40), dtype=np.uint8)
+    expected[7:14, 16:25] = 1
+    np.testing.assert_array_equal(annotator._draw_labels(), expected)
+
+
+def test_drawing_without_a_backend_raises_import_error(tmp_path,
+                                                      monkeypatch):
+    annotator = _annotator(tmp_path, [], {'a': 1})
+    for module in ('cv2', 'shapely', 'numba'):
+        monkeypatch.setattr(annotate_labels, module, None)
+    with pytest.raises(ImportError):
+        annotator._draw_labels()
+
+
+@pytest.mark.parametrize('label', [[255, 0, 0], 1.5, True, -1, 65536])
+def test_colormap_rejects_labels_that_are_not_uint16(tmp_path, label):
+    colormap_file = tmp_path / 'colormap.json'
+    colormap_file.write_text(json.dumps({'a': label}))
+    with pytest.raises(ValueError, match='does not fit in uint16'):
+        LabelAnnotator(FakeClient({}, b'')).colormap = str(colormap_file)
+
+
+def test_girder_id_is_stored_and_not_reloaded(tmp_path):
+    annotator = _annotator(tmp_path, [], {'a': 1})
+    client = annotator.client
+    assert annotator.girder_id == 'item'
+    assert client.calls == ['overlay', 'item/overlay-item/files',
+                            'annotation/item/item']
+
+    del client.calls[:]
+    annotator.girder_id = 'item'
+    assert client.calls == []
+
+
+def test_failed_girder_id_is_not_recorded(tmp_path):
+    annotator = _annotator(tmp_path, [], {'a': 1})
+    annotator.client.routes['overlay'] = lambda parameters: (
+        [] if parameters['itemId'] == 'BAD'
+        else [{'overlayItemId': 'overlay-item'}])
+
+    for attempt in range(2):
+        with pytest.raises(ValueError, match='no overlay for item BAD'):
+            annotator.girder_id = 'BAD'
+        assert annotator.girder_id is None
+        assert annotator.overlay_file is None
+
+
+def test_toggling_is_overlay_id_reloads_the_same_id(tmp_path):
+    annotator = _annotator(tmp_path, [], {'a': 1})
+    client = annotator.client
+    client.routes['overlay/item'] = {'itemId': 'item',
+                                     'overlayItemId': 'overlay-item'}
+
+    del client.calls[:]
+    annotator.is_overlay_id = True
+    annotator.girder_id = 'item'
+    assert client.calls == ['overlay/item', 'annotation/item/item']
+
+
+def test_interleaved_names_form_one_group_per_name(tmp_path):
+    annotator = _annotator(tmp_path, [
+        _annotation('b'), _annotation('a'), {'annotation': {'elements': []}},
+        _annotation('b'), _annotation('c'), _annotation('a'),
+    ], {'a': 1, 'b': 2, 'c': 3})
+
+    groups = [(color, len(list(group)))
+              for color, group in annotator.annotations]
+    assert groups == [(1, 2), (2, 2), (3, 1)]
+
+
+def test_callers_session_is_reused_and_left_open():
+    overlay = _overlay_png()
+    client = FakeClient(_routes([], overlay), overlay)
+    annotator = LabelAnnotator(client)
+
+    with client.session() as session:
+        annotator.girder_id = 'item'
+        annotator.image
+        assert client._session is session
+    assert client._session is None
+
+
+def test_pooled_session_is_opened_when_caller_has_none():
+    overlay = _overlay_png()
+    client = FakeClient(_routes([], overlay), overlay)
+    sessions = []
+    client.routes['annotation/item/item'] = lambda parameters: (
+        sessions.append(client._session) or [])
+
+    LabelAnnotator(client).girder_id = 'item'
+    assert isinstance(sessions[0], requests.Session)
+    assert client._session is None